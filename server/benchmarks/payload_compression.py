@@ -0,0 +1,75 @@
+"""
+Compare DB size and item read latency with and without payload compression.
+
+	poetry run python benchmarks/payload_compression.py [num_items] [num_users]
+"""
+import sys
+import json
+import random
+import tempfile
+from os import path, urandom
+from time import perf_counter
+
+from nacl.public import PrivateKey, SealedBox
+
+from thingbox import payload
+from thingbox.db import DB
+
+
+ASSETS = ['tDAI', 'tEURO', 'tBTC', 'tUSDC']
+REWARD_TYPES = ['Liquidity provision', 'Maker fees', 'Trading competition', 'Bug bounty']
+
+
+def make_record(i, target_id):
+	return {
+		'target_type': 'twitter',
+		'target_id': target_id,
+		'category': 'reward',
+		'template': 'reward-payout',
+		'reward_type': random.choice(REWARD_TYPES),
+		'asset': random.choice(ASSETS),
+		'amount': str(random.randint(1, 10 ** 6) * 10 ** 15),
+		'epoch': random.randint(1, 500),
+		'date': f'2021-09-{random.randint(1, 30):02d}T{random.randint(0, 23):02d}:00:00Z',
+		'tx_hash': urandom(32).hex(),
+		'party': urandom(32).hex(),
+		'description': 'Thanks for taking part in Fairground incentives. Rewards are paid to the Vega key you registered.',
+	}
+
+
+def build_db(filepath, private_key, records, compress):
+	db = DB(filepath=filepath, private_key_bytes=bytes(private_key), id_len_bytes=16)
+	box = SealedBox(private_key.public_key)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin)
+	db.add_template('reward-payout', '{{reward_type}}: {{amount}} {{asset}}')
+	for r in records:
+		ciphertext = box.encrypt(payload.encode(json.dumps(r), compress=compress))
+		db.add_item(batch, r['target_type'], r['target_id'], r['category'], ciphertext, r['template'])
+	db.close_batch(batch)
+	return db
+
+
+def time_reads(db, target_ids, repeat=5):
+	start = perf_counter()
+	for _ in range(repeat):
+		for target_id in target_ids:
+			db.get_items('twitter', target_id)
+	return (perf_counter() - start) / (repeat * len(target_ids))
+
+
+def main(num_items=20000, num_users=2000):
+	random.seed(1)
+	private_key = PrivateKey.generate()
+	users = [str(10 ** 18 + i) for i in range(num_users)]
+	records = [make_record(i, random.choice(users)) for i in range(num_items)]
+	with tempfile.TemporaryDirectory() as tmp:
+		for compress in (False, True):
+			filepath = path.join(tmp, f'bench_{compress}.db')
+			db = build_db(filepath, private_key, records, compress)
+			latency = time_reads(db, users[:200])
+			print(f'compress={compress}: db size {path.getsize(filepath) / 1024:.0f} KiB, get_items {latency * 1000:.3f} ms/user')
+
+
+if __name__ == '__main__':
+	main(*[int(x) for x in sys.argv[1:3]])
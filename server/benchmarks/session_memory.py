@@ -0,0 +1,44 @@
+"""
+Measure the memory held by user_sessions when it is full.
+
+	poetry run python benchmarks/session_memory.py [num_sessions]
+"""
+import sys
+import tracemalloc
+from os import urandom
+
+from base58 import b58encode
+from cachetools import TTLCache
+
+from thingbox.session import UserSession
+
+
+def random_str(num_bytes):
+	return b58encode(urandom(num_bytes)).decode('utf-8')
+
+
+def make_session(i):
+	return UserSession(
+		id_str=str(1000000000000000000 + i),
+		screen_name=f'user_{i:08d}',
+		access_token=f'{1000000000000000000 + i}-{random_str(30)}',
+		access_token_secret=random_str(33))
+
+
+def main(num_sessions=65536):
+	user_sessions = TTLCache(maxsize=num_sessions, ttl=3600)
+	tokens = [random_str(32) for _ in range(num_sessions)]
+	tracemalloc.start()
+	before, _ = tracemalloc.get_traced_memory()
+	for i, token in enumerate(tokens):
+		user_sessions[token] = make_session(i)
+	after, _ = tracemalloc.get_traced_memory()
+	tracemalloc.stop()
+	total = after - before
+	print(f'sessions: {len(user_sessions)}')
+	print(f'total: {total / 1024 / 1024:.1f} MiB')
+	print(f'per session: {total / num_sessions:.0f} bytes')
+
+
+if __name__ == '__main__':
+	main(*[int(x) for x in sys.argv[1:2]])
@@ -0,0 +1,114 @@
+import sqlite3
+
+import pytest
+from nacl.public import PrivateKey, SealedBox
+
+from thingbox.db import DB, ReplicaConfig
+
+
+def open_db(filepath, private_key, item_shards):
+	return DB(filepath=str(filepath), private_key_bytes=bytes(private_key), id_len_bytes=16, item_shards=item_shards)
+
+
+@pytest.mark.parametrize('item_shards,reopen_item_shards', [(4, 8), (4, 2), (4, 0)])
+def test_changing_item_shards_is_refused(tmp_path, item_shards, reopen_item_shards):
+	private_key = PrivateKey.generate()
+	box = SealedBox(private_key.public_key)
+	filepath = tmp_path / 'thingbox.db'
+	db = open_db(filepath, private_key, item_shards)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin)
+	db.add_template('template', 'content')
+	for i in range(20):
+		assert db.add_item(batch, 'twitter', str(i), 'category', box.encrypt(b'{}'), 'template')
+
+	assert len(open_db(filepath, private_key, item_shards).get_items('twitter', '7')) == 1
+	with pytest.raises(Exception):
+		open_db(filepath, private_key, reopen_item_shards)
+
+
+def test_uploads_to_retired_key_are_stored_under_current_key(tmp_path):
+	retired_key, current_key = PrivateKey.generate(), PrivateKey.generate()
+	retired_box = SealedBox(retired_key.public_key)
+	db = DB(filepath=str(tmp_path / 'thingbox.db'), private_key_bytes=bytes(current_key), id_len_bytes=16, retired_private_keys_bytes=[bytes(retired_key)])
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin, shared_data_encrypted=retired_box.encrypt(b'{"shared": 1}'))
+	db.add_template('template', 'content')
+	assert db.add_item(batch, 'twitter', '1', 'category', retired_box.encrypt(b'{"item": 1}'), 'template')
+
+	assert db.get_key_rotation_status()['remaining'] == 0
+	[item] = db.get_items('twitter', '1')
+	assert (item['data'], item['shared_data']) == ('{"item": 1}', { 'shared': 1 })
+
+
+def test_key_ids_are_backfilled_when_no_keys_are_retired(tmp_path):
+	private_key = PrivateKey.generate()
+	box = SealedBox(private_key.public_key)
+	filepath = tmp_path / 'thingbox.db'
+	db = open_db(filepath, private_key, 0)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin, shared_data_encrypted=box.encrypt(b'{}'))
+	db.add_template('template', 'content')
+	for i in range(5):
+		assert db.add_item(batch, 'twitter', str(i), 'category', box.encrypt(b'{}'), 'template')
+	with db._db as sql:
+		sql.execute('UPDATE items SET key_id = NULL')
+		sql.execute('UPDATE batches SET shared_data_key_id = NULL')
+
+	assert 'remaining' not in db.get_key_rotation_status()
+	assert db.backfill_key_ids(chunk_size=2, interval=0) == 6
+	assert db.count_items_to_rotate() == 0
+
+
+@pytest.mark.parametrize('shared_data', [b'[1, 2]', b'not json', b'"string"'])
+def test_batch_shared_data_must_be_a_json_object(tmp_path, shared_data):
+	private_key = PrivateKey.generate()
+	db = open_db(tmp_path / 'thingbox.db', private_key, 0)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	assert db.create_or_check_batch(admin=admin, shared_data_encrypted=SealedBox(private_key.public_key).encrypt(shared_data)) is None
+
+
+def test_replica_refuses_out_of_date_snapshot(tmp_path):
+	snapshot_path = tmp_path / 'backups'
+	snapshot_path.mkdir()
+	snapshot = sqlite3.connect(str(snapshot_path / 'thingbox_db_backup_20210101-000000.000000.db'))
+	with snapshot as sql:
+		sql.execute('CREATE TABLE items (id INTEGER PRIMARY KEY AUTOINCREMENT, data TEXT NOT NULL)')
+		sql.execute('CREATE TABLE batches (id TEXT NOT NULL PRIMARY KEY)')
+	snapshot.close()
+	replica_config = ReplicaConfig(snapshot_path=str(snapshot_path), name_glob='thingbox_db_backup_*.db')
+	with pytest.raises(Exception, match='out of date'):
+		DB(filepath=None, private_key_bytes=bytes(PrivateKey.generate()), id_len_bytes=16, replica_config=replica_config)
+
+
+def test_item_ids_are_unique_across_shards(tmp_path):
+	private_key = PrivateKey.generate()
+	box = SealedBox(private_key.public_key)
+	db = open_db(tmp_path / 'thingbox.db', private_key, 4)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin)
+	db.add_template('template', 'content')
+	for i in range(20):
+		assert db.add_item(batch, 'twitter', str(i), 'category', box.encrypt(b'{}'), 'template')
+
+	items = db.get_items_summary_multi([('twitter', str(i)) for i in range(20)])
+	assert len(set(item['id'] for item in items)) == 20
+
+
+def test_key_rotation_pending_excludes_failed_rows(tmp_path):
+	retired_key, current_key, unknown_key = PrivateKey.generate(), PrivateKey.generate(), PrivateKey.generate()
+	filepath = tmp_path / 'thingbox.db'
+	db = open_db(filepath, retired_key, 0)
+	admin = db.make_admin('twitter', '1') and db.is_admin('twitter', '1')
+	batch = db.create_or_check_batch(admin=admin)
+	db.add_template('template', 'content')
+	assert db.add_item(batch, 'twitter', '1', 'category', SealedBox(retired_key.public_key).encrypt(b'{}'), 'template')
+	with db._db as sql:
+		sql.execute(
+			"INSERT INTO items (batch_id, target_type, target_id, category, data, data_format, template_id) VALUES (:batch, 'twitter', '2', 'category', :data, 1, 'template')",
+			dict(batch=batch, data=SealedBox(unknown_key.public_key).encrypt(b'{}')))
+
+	db = DB(filepath=str(filepath), private_key_bytes=bytes(current_key), id_len_bytes=16, retired_private_keys_bytes=[bytes(retired_key)])
+	db.rotate_keys(chunk_size=10, interval=0)
+	status = db.get_key_rotation_status()
+	assert (status['done'], status['failed'], status['remaining'], status['pending']) == (1, 1, 1, 0)
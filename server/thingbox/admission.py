@@ -0,0 +1,90 @@
+from time import monotonic
+from collections import Counter
+
+from cachetools import LRUCache
+from fastapi.responses import JSONResponse
+
+
+class TokenBucket:
+	__slots__ = ('tokens', 'updated')
+
+	def __init__(self, tokens, updated):
+		self.tokens = tokens
+		self.updated = updated
+
+	def take(self, rate, burst, now):
+		self.tokens = min(burst, self.tokens + (now - self.updated) * rate)
+		self.updated = now
+		if self.tokens < 1: return False
+		self.tokens -= 1
+		return True
+
+
+class RateLimiter:
+
+	def __init__(self, limits, max_clients):
+		self._limits = limits
+		self._buckets = LRUCache(maxsize=max_clients)
+
+	def allow(self, route_class, client_ip):
+		if (limit := self._limits.get(route_class)) is None: return True
+		rate, burst = limit
+		if rate <= 0: return True
+		now = monotonic()
+		key = (route_class, client_ip)
+		if (bucket := self._buckets.get(key)) is None:
+			bucket = self._buckets[key] = TokenBucket(tokens=burst, updated=now)
+		return bucket.take(rate=rate, burst=burst, now=now)
+
+	def retry_after(self, route_class):
+		rate, _ = self._limits[route_class]
+		return max(1, round(1 / rate))
+
+
+class AdmissionControl:
+	"""
+	Rejects requests up front rather than queueing them: 503 when the server
+	already has max_concurrent_requests in flight, 429 when a client IP has
+	used up its token bucket for the route class.
+	"""
+
+	def __init__(self, rate_limiter, classify_route, max_concurrent_requests=0):
+		self.rate_limiter = rate_limiter
+		self.classify_route = classify_route
+		self.max_concurrent_requests = max_concurrent_requests
+		self.in_flight = 0
+		self.rejected = Counter()
+
+	def reject(self, path, client_ip):
+		if self.max_concurrent_requests > 0 and self.in_flight >= self.max_concurrent_requests:
+			self.rejected['concurrency'] += 1
+			return JSONResponse(status_code=503, content=dict(detail='server busy'), headers={ 'Retry-After': '1' })
+		route_class = self.classify_route(path)
+		if not self.rate_limiter.allow(route_class, client_ip):
+			self.rejected[route_class] += 1
+			return JSONResponse(
+				status_code=429,
+				content=dict(detail='too many requests'),
+				headers={ 'Retry-After': str(self.rate_limiter.retry_after(route_class)) })
+		return None
+
+	def stats(self):
+		return dict(in_flight=self.in_flight, rejected=dict(self.rejected))
+
+
+class AdmissionControlMiddleware:
+
+	def __init__(self, app, admission):
+		self.app = app
+		self.admission = admission
+
+	async def __call__(self, scope, receive, send):
+		if scope['type'] != 'http': return await self.app(scope, receive, send)
+		client_ip = scope['client'][0] if scope.get('client') else None
+		if (response := self.admission.reject(scope['path'], client_ip)) is not None:
+			return await response(scope, receive, send)
+		self.admission.in_flight += 1
+		try:
+			await self.app(scope, receive, send)
+		finally:
+			self.admission.in_flight -= 1
@@ -1,8 +1,10 @@
 import json
+from base64 import b64decode
+from binascii import Error as Base64Error
 from os import urandom, environ
-from dataclasses import dataclass
 from typing import List, Optional
 from datetime import datetime
+from functools import lru_cache
 
 import tweepy
 import chevron
@@ -14,9 +16,12 @@ from fastapi.responses import RedirectResponse, JSONResponse
 from fastapi.security import OAuth2PasswordBearer
 from fastapi.middleware.cors import CORSMiddleware
 from fastapi.staticfiles import StaticFiles
+from fastapi.routing import APIRoute
 
 from thingbox import __version__ as version
-from thingbox.db import DB, BackupConfig
+from thingbox.db import DB, BackupConfig, ReplicaConfig, KeyRotationConfig
+from thingbox.session import UserSession
+from thingbox.admission import AdmissionControl, AdmissionControlMiddleware, RateLimiter
 
 
 TEMPLATE_GLOBALS = { 
@@ -36,21 +41,38 @@ class Config(BaseSettings):
 	twitter_api_key: str
 	twitter_api_secret: str
 	database_file: str
+	item_shards: int = 0
 	private_key_b58: str
+	retired_private_keys_b58: Optional[str] = None
+	key_rotation_chunk_size: int = 100
+	key_rotation_interval: float = 1.0
 	backup_path: Optional[str] = None
 	backup_interval: Optional[int] = None
 	backup_tmp_path: Optional[str] = None
 	backup_on_batch_close: bool = False
+	replica_snapshot_path: Optional[str] = None
+	replica_poll_interval: int = 60
+	replica_mmap_size: int = 268435456
 	auth_timeout: int = 303
 	session_ttl: int = 3600
 	admin_ttl: int = 900
 	max_concurrent_auth_attempts: int = 8192
 	max_concurrent_sessions: int = 65536
 	max_admin_tokens: int = 32
+	legacy_conversion_chunk_size: int = 500
 	token_length_bytes: int = 32
 	id_length_bytes: int = 16
 	template_cache_size: int = 64
+	screen_name_cache_size: int = 65536
+	screen_name_cache_ttl: int = 86400
+	max_check_targets: int = 1000
 	static_files_path: Optional[str] = None
+	rate_limit_auth_rate: float = 0.2
+	rate_limit_auth_burst: int = 10
+	rate_limit_public_rate: float = 10
+	rate_limit_public_burst: int = 100
+	rate_limit_max_clients: int = 65536
+	max_concurrent_requests: int = 256
 
 	@property
 	def twitter_api_credentials(self):
@@ -60,13 +82,20 @@ class Config(BaseSettings):
 environment = environ.get('THINGBOX_ENV', 'dev')
 config = Config(_env_file=f'{environment}.env')
 
-if config.private_key_b58[:11] == 'gcp_secret:':
-	from google.cloud import secretmanager
-	client = secretmanager.SecretManagerServiceClient()
-	gcp_secret_name = config.private_key_b58[11:]
-	response = client.access_secret_version(name=gcp_secret_name)
-	config.private_key_b58 = response.payload.data.decode("UTF-8")
-	print('** Loaded private key from GCP secret **')
+
+def load_private_key_b58(private_key_b58):
+	if private_key_b58[:11] == 'gcp_secret:':
+		from google.cloud import secretmanager
+		client = secretmanager.SecretManagerServiceClient()
+		gcp_secret_name = private_key_b58[11:]
+		response = client.access_secret_version(name=gcp_secret_name)
+		print('** Loaded private key from GCP secret **')
+		return response.payload.data.decode("UTF-8")
+	return private_key_b58
+
+
+config.private_key_b58 = load_private_key_b58(config.private_key_b58)
+retired_private_keys_b58 = [load_private_key_b58(k.strip()) for k in (config.retired_private_keys_b58 or '').split(',') if k.strip()]
 
 
 app = FastAPI(
@@ -80,14 +109,54 @@ db_backup_config = BackupConfig(
 	backup_interval=config.backup_interval,
 	backup_on_batch_close=True,
 	name_template='thingbox_db_backup_{timestamp}.db'
-) if config.backup_path else None
+) if config.backup_path and not config.replica_snapshot_path else None
+
+db_replica_config = ReplicaConfig(
+	snapshot_path=config.replica_snapshot_path,
+	name_glob='thingbox_db_backup_*.db',
+	poll_interval=config.replica_poll_interval,
+	mmap_size=config.replica_mmap_size,
+	on_reload=lambda: template_cache.clear()
+) if config.replica_snapshot_path else None
 
 db = DB(
 	filepath=config.database_file,
 	private_key_bytes=b58decode(config.private_key_b58), 
 	id_len_bytes=config.id_length_bytes,
-	backup_config=db_backup_config)
+	backup_config=db_backup_config,
+	conversion_chunk_size=config.legacy_conversion_chunk_size,
+	replica_config=db_replica_config,
+	item_shards=config.item_shards,
+	retired_private_keys_bytes=[b58decode(k) for k in retired_private_keys_b58],
+	key_rotation_config=KeyRotationConfig(chunk_size=config.key_rotation_chunk_size, interval=config.key_rotation_interval))
+
+AUTH_ROUTES = {'auth', 'auth-complete'}
+PUBLIC_ROUTES = {'content', 'public-key'}
+
+
+@lru_cache(maxsize=None)
+def api_route_prefixes():
+	return frozenset(route.path.split('/')[1] for route in app.routes if isinstance(route, APIRoute))
+
 
+def classify_route(path):
+	# anything that isn't an API route is served by the static mount, which is public too
+	prefix = path.split('/')[1]
+	if prefix in AUTH_ROUTES: return 'auth'
+	if prefix in PUBLIC_ROUTES or prefix not in api_route_prefixes(): return 'public'
+	return None
+
+
+admission = AdmissionControl(
+	rate_limiter=RateLimiter(
+		limits=dict(
+			auth=(config.rate_limit_auth_rate, config.rate_limit_auth_burst),
+			public=(config.rate_limit_public_rate, config.rate_limit_public_burst)),
+		max_clients=config.rate_limit_max_clients),
+	classify_route=classify_route,
+	max_concurrent_requests=config.max_concurrent_requests)
+
+app.add_middleware(AdmissionControlMiddleware, admission=admission)
 app.add_middleware(CORSMiddleware, allow_origins=['*'], allow_headers=['Authorization'])
 auth_scheme = OAuth2PasswordBearer(tokenUrl='auth')
 
@@ -95,14 +164,10 @@ auth_sessions = TTLCache(maxsize=config.max_concurrent_auth_attempts, ttl=config
 user_sessions = TTLCache(maxsize=config.max_concurrent_sessions, ttl=config.session_ttl)
 admin_tokens = TTLCache(maxsize=config.max_admin_tokens, ttl=config.admin_ttl)
 template_cache = LRUCache(maxsize=config.template_cache_size)
+screen_name_cache = TTLCache(maxsize=config.screen_name_cache_size, ttl=config.screen_name_cache_ttl)
 
-
-@dataclass
-class UserSession:
-	api: tweepy.API
-	user: tweepy.User
-	admin_token: Optional[str] = None
-	admin_id: Optional[int] = None
+TWITTER_LOOKUP_USERS_MAX = 100
+TWITTER_NO_USER_MATCHES = 17
 
 
 class AuthResponse(BaseModel):
@@ -110,6 +175,15 @@ class AuthResponse(BaseModel):
 	redirect_url: str
 
 
+class Batch(BaseModel):
+	shared_data_encrypted_b64: Optional[str] = None
+
+
+class Target(BaseModel):
+	target_type: str
+	target_id: str
+
+
 class Item(BaseModel):
 	target_type: str
 	target_id: str
@@ -119,6 +193,13 @@ class Item(BaseModel):
 	batch: str = None
 
 
+def decode_b64_field(name, value):
+	try:
+		return b64decode(value, validate=True)
+	except (Base64Error, ValueError):
+		raise HTTPException(status_code=400, detail=f'{name} is not valid base64')
+
+
 def make_token():
 	return b58encode(urandom(config.token_length_bytes)).decode('utf-8')
 
@@ -130,6 +211,33 @@ def get_template_cached(template):
 		return content
 
 
+def resolve_screen_names(session, screen_names):
+	result, failed = {}, {}
+	to_lookup = []
+	for screen_name in dict.fromkeys(x.lower() for x in screen_names):
+		if screen_name in screen_name_cache: result[screen_name] = screen_name_cache[screen_name]
+		else: to_lookup.append(screen_name)
+	if len(to_lookup) > 0:
+		api = session.make_api(**config.twitter_api_credentials)
+		for i in range(0, len(to_lookup), TWITTER_LOOKUP_USERS_MAX):
+			chunk = to_lookup[i:i + TWITTER_LOOKUP_USERS_MAX]
+			try:
+				users = api.lookup_users(screen_names=chunk)
+			except Exception as e:
+				if getattr(e, 'api_code', None) == TWITTER_NO_USER_MATCHES: continue
+				print(f'Error looking up screen names: {repr(e)}')
+				failed.update({ screen_name: repr(e) for screen_name in chunk })
+				continue
+			for user in users:
+				screen_name_cache[user.screen_name.lower()] = user.id_str
+				result[user.screen_name.lower()] = user.id_str
+	return result, failed
+
+
+def db_is_writable():
+	if db.read_only: raise HTTPException(status_code=503, detail='read-only replica, send writes to the primary server')
+
+
 def user_is_authenticated(token: str=Depends(auth_scheme)):
 	if token in user_sessions:
 		return user_sessions[token]
@@ -138,7 +246,7 @@ def user_is_authenticated(token: str=Depends(auth_scheme)):
 
 
 def authenticated_user_is_editor(session: UserSession=Depends(user_is_authenticated)):
-	if (admin_id := db.is_editor(user_type='twitter', user_id=session.user.id_str)):
+	if (admin_id := db.is_editor(user_type='twitter', user_id=session.id_str)):
 		session.admin_id = admin_id
 		return session
 	else:
@@ -146,7 +254,7 @@ def authenticated_user_is_editor(session: UserSession=Depends(user_is_authentica
 
 
 def authenticated_user_is_admin(session: UserSession=Depends(user_is_authenticated)):
-	if (admin_id := db.is_admin(user_type='twitter', user_id=session.user.id_str)):
+	if (admin_id := db.is_admin(user_type='twitter', user_id=session.id_str)):
 		session.admin_id = admin_id
 		return session
 	else:
@@ -155,7 +263,7 @@ def authenticated_user_is_admin(session: UserSession=Depends(user_is_authenticat
 
 def api_token_is_admin_token(token: str=Depends(auth_scheme)):
 	if (session := admin_tokens.get(token, None)) is not None:
-		if (admin_id := db.is_admin(user_type='twitter', user_id=session.user.id_str)):
+		if (admin_id := db.is_admin(user_type='twitter', user_id=session.id_str)):
 			session.admin_id = admin_id
 			return session
 		else:
@@ -183,26 +291,26 @@ def auth_complete(token: str, oauth_verifier: Optional[str] = None, denied: Opti
 			auth.get_access_token(oauth_verifier)
 			api = tweepy.API(auth)
 			user = api.verify_credentials()
-			user_sessions[token] = UserSession(api=api, user=user)
+			user_sessions[token] = UserSession.from_auth(auth=auth, user=user)
 	return RedirectResponse(config.app_base_url + ('/#denied' if denied else ''))
 
 
 @app.get('/user')
 def get_items(session: UserSession=Depends(user_is_authenticated)):
 	return JSONResponse(dict(
-		screen_name=session.user.screen_name, 
-		id=session.user.id_str,
-		admin=db.is_admin(user_type='twitter', user_id=session.user.id_str),
-		editor=db.is_editor(user_type='twitter', user_id=session.user.id_str)))
+		screen_name=session.screen_name, 
+		id=session.id_str,
+		admin=db.is_admin(user_type='twitter', user_id=session.id_str),
+		editor=db.is_editor(user_type='twitter', user_id=session.id_str)))
 
 
 @app.get('/items')
 def get_items(session: UserSession=Depends(user_is_authenticated)):
-	result = db.get_items('twitter', session.user.id_str)
+	result = db.get_items('twitter', session.id_str)
 	items = []
 	for r in filter(lambda r: r is not None, result):
 		try:
-			items.append(chevron.render(template=get_template_cached(r['template_id']), data={ **json.loads(r['data']), **TEMPLATE_GLOBALS}))
+			items.append(chevron.render(template=get_template_cached(r['template_id']), data={ **(r['shared_data'] or {}), **json.loads(r['data']), **TEMPLATE_GLOBALS}))
 		except Exception as e:
 			print(f'Template error rendering item {r["id"]} in template: {r["template_id"]}')
 			print(e)
@@ -210,19 +318,34 @@ def get_items(session: UserSession=Depends(user_is_authenticated)):
 	return items
 
 
-@app.post('/items')
+@app.post('/items', dependencies=[Depends(db_is_writable)])
 def post_item(item: Item, batch: Optional[str] = None, close_batch: Optional[bool] = True, session: UserSession=Depends(api_token_is_admin_token)):
+	data_encrypted = decode_b64_field('data_encrypted_b64', item.data_encrypted_b64)
 	if batch is None: batch = db.create_or_check_batch(admin=session.admin_id, batch=batch)
 	if not batch: raise HTTPException(status_code=400, detail='error creating batch, is user an admin?')
 	if not db.get_template(item.template): db.add_template(item.template, f'New template: {item.template}')
-	res = db.add_item(**{ **item.dict(), **dict(batch=batch) })
+	res = db.add_item(
+		batch=batch,
+		target_type=item.target_type,
+		target_id=item.target_id,
+		category=item.category,
+		data_encrypted=data_encrypted,
+		template=item.template)
 	if close_batch: db.close_batch(batch)
 	return { **dict(batch=batch, success=res), **(dict(error=f'error creating item, ensure template exists: {item.template}') if not res else {}) }
 
 
+@app.post('/batches', dependencies=[Depends(db_is_writable)])
+def create_batch(batch: Batch, session: UserSession=Depends(api_token_is_admin_token)):
+	shared_data_encrypted = decode_b64_field('shared_data_encrypted_b64', batch.shared_data_encrypted_b64) if batch.shared_data_encrypted_b64 else None
+	batch_id = db.create_or_check_batch(admin=session.admin_id, shared_data_encrypted=shared_data_encrypted)
+	if not batch_id: raise HTTPException(status_code=400, detail='error creating batch, shared data must be a JSON object encrypted to the server key')
+	return dict(batch=batch_id)
+
+
 @app.get('/public-key')
 def get_public_key():
-	return dict(public_key_b58=b58encode(db.get_public_key().encode()).decode())
+	return dict(public_key_b58=b58encode(db.get_public_key().encode()).decode(), key_id=db.get_key_id())
 
 
 @app.get('/clear-template-cache')
@@ -241,6 +364,16 @@ def get_admin_token(session: UserSession=Depends(authenticated_user_is_editor)):
 	return dict(admin_token=token)
 
 
+@app.get('/admission-stats')
+def get_admission_stats(session: UserSession=Depends(authenticated_user_is_admin)):
+	return admission.stats()
+
+
+@app.get('/key-rotation')
+def get_key_rotation_status(session: UserSession=Depends(api_token_is_admin_token)):
+	return db.get_key_rotation_status()
+
+
 @app.get('/templates')
 def get_templates(session: UserSession=Depends(authenticated_user_is_editor)):
 	return db.get_templates()
@@ -254,7 +387,7 @@ def get_template(template_id, session: UserSession=Depends(authenticated_user_is
 		return res
 
 
-@app.post('/templates/{template_id}')
+@app.post('/templates/{template_id}', dependencies=[Depends(db_is_writable)])
 def create_template(template_id, content: str = Body(default=None), session: UserSession=Depends(authenticated_user_is_editor)):
 	if content is None: raise HTTPException(status_code=400, detail='Template content required in request body')
 	success = db.add_template(template_id=template_id, content=content)
@@ -262,7 +395,7 @@ def create_template(template_id, content: str = Body(default=None), session: Use
 	return dict(success=success)
 
 
-@app.put('/templates/{template_id}')
+@app.put('/templates/{template_id}', dependencies=[Depends(db_is_writable)])
 def update_template(template_id, type: str = 'item', content: str = Body(default=None), session: UserSession=Depends(authenticated_user_is_editor)):
 	if content is None: raise HTTPException(status_code=400, detail='Template content required in request body')
 	success = db.update_template(template_id=template_id, content=content, type=type)
@@ -284,16 +417,36 @@ def get_site_content(id: str):
 def check_items(target_type: str, target_id: str, session: UserSession=Depends(authenticated_user_is_admin)):
 	result = []
 	if target_type == 'twitter' and not target_id.isdigit():
-		try:
-			if target_id[0] == '@': target_id = target_id[1:]
-			[user] = session.api.lookup_users(screen_names=[target_id])
-			result.append(f'Converted @{target_id} to #{user.id_str}')
-			target_id = user.id_str
-		except Exception:
-			return result
+		if target_id[0] == '@': target_id = target_id[1:]
+		resolved, failed = resolve_screen_names(session, [target_id])
+		if (id_str := resolved.get(target_id.lower())) is None:
+			return result + [f'Error looking up @{target_id}: {failed[target_id.lower()]}' if target_id.lower() in failed else f'No such user: @{target_id}']
+		result.append(f'Converted @{target_id} to #{id_str}')
+		target_id = id_str
 	items = db.get_items_summary(target_type=target_type, target_id=target_id)
 	return result + (items if len(items) > 0 else [f'No results for user: {target_type}/{target_id}'])
 
 
+@app.post('/check')
+def check_items_multi(targets: List[Target], session: UserSession=Depends(authenticated_user_is_admin)):
+	if len(targets) > config.max_check_targets: raise HTTPException(status_code=400, detail=f'Too many targets, maximum is {config.max_check_targets}')
+	screen_names = [t.target_id.lstrip('@') for t in targets if t.target_type == 'twitter' and not t.target_id.isdigit()]
+	resolved, failed = resolve_screen_names(session, screen_names) if len(screen_names) > 0 else ({}, {})
+	results = []
+	for t in targets:
+		target_id, error = t.target_id, None
+		if t.target_type == 'twitter' and not target_id.isdigit():
+			screen_name = target_id.lstrip('@').lower()
+			target_id = resolved.get(screen_name)
+			if target_id is None: error = f'lookup failed: {failed[screen_name]}' if screen_name in failed else 'no such user'
+		results.append(dict(target_type=t.target_type, query=t.target_id, target_id=target_id, items=[], **(dict(error=error) if error else {})))
+	by_target = {}
+	for r in results:
+		if r['target_id'] is not None: by_target.setdefault((r['target_type'], r['target_id']), []).append(r)
+	for item in db.get_items_summary_multi(targets=by_target.keys()):
+		for r in by_target[(item['target_type'], item['target_id'])]: r['items'].append(item)
+	return results
+
+
 if config.static_files_path:
 	app.mount("/", StaticFiles(directory=config.static_files_path, html=True), name="static")
@@ -22,11 +22,12 @@ def global_options(server=True, auth_token=True):
 @cli.command(help='Encrypt data to the server\'s public key')
 @global_options(auth_token=False)
 @click.option('-d', '--data')
+@click.option('-z', '--compress', required=False, default=False, is_flag=True, help='Compress data before encrypting')
 @click.argument('data_file', type=click.File('rb'), required=False, default=sys.stdin)
-def encrypt(server, data, data_file):
+def encrypt(server, data, compress, data_file):
 	public_key = client.get_public_key(server)
 	if data is None: data = data_file.read()
-	ciphertext = client.encrypt(plaintext=data, public_key_b58=public_key)
+	ciphertext = client.encrypt(plaintext=data, public_key_b58=public_key, compress=compress)
 	click.echo(ciphertext)
 
 
@@ -36,6 +37,16 @@ def generate_key():
 	click.echo(private_key)
 
 
+@cli.command(help='Show progress of re-encrypting data to the server\'s current key')
+@global_options()
+def key_rotation_status(server, auth_token):
+	try:
+		status = client.get_key_rotation_status(server_base_url=server, auth_token=auth_token)
+		click.echo(json.dumps(status, indent=2))
+	except Exception as e:
+		click.echo(e)
+
+
 @cli.command(help="Encrypt and add an item for a given user ID")
 @global_options()
 @click.option(
@@ -45,8 +56,9 @@ def generate_key():
 @click.option('-t', '--template', required=True, default=None, help='Template ID to render with')
 @click.option('-c', '--category', required=True, default=None, help='Item category metadata')
 @click.option('-d', '--data', required=False, default=None, help='Item data in plaintext JSON')
+@click.option('-z', '--compress', required=False, default=False, is_flag=True, help='Compress item data before encrypting')
 @click.argument('data_file', type=click.File('rb'), required=False, default=sys.stdin)
-def add_item(server, auth_token, target_user, template, category, data, data_file):
+def add_item(server, auth_token, target_user, template, category, data, compress, data_file):
 	target_type, target_id = target_user
 	if data is None: data = data_file.read()
 	try:
@@ -57,7 +69,8 @@ def add_item(server, auth_token, target_user, template, category, data, data_fil
 			target_id=target_id, 
 			category=category,
 			data_plaintext=data,
-			template_id=template)
+			template_id=template,
+			compress=compress)
 		click.echo(result)
 	except Exception as e:
 		click.echo(e)
@@ -76,6 +89,7 @@ def add_item(server, auth_token, target_user, template, category, data, data_fil
 @click.option('--template', required=False, default=None, help='Set/override template for all items')
 @click.option('--csv', required=False, default=False, is_flag=True, help='Process file in CSV format rather than JSON')
 @click.option('-g', '--global-data', required=False, default=[], nargs=2, multiple=True, help="Inject data all items, e.g. -g key value")
+@click.option('-z', '--compress', required=False, default=False, is_flag=True, help='Compress item data before encrypting')
 @click.argument('items_file', type=click.File('r'), required=True, default=sys.stdin)
 def import_items(
 		server, 
@@ -90,6 +104,7 @@ def import_items(
 		template,
 		csv,
 		global_data,
+		compress,
 		items_file,
 		send):
 	global_data = { k: v for k, v in global_data }
@@ -110,6 +125,7 @@ def import_items(
 			override_category=category,
 			override_template_id=template,
 			global_data=global_data,
+			compress=compress,
 			items=items,
 			dry_run=not send,
 			log_fn=click.echo)
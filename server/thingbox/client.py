@@ -5,6 +5,8 @@ from base58 import b58decode, b58encode
 from base64 import b64encode
 from nacl.public import SealedBox, PublicKey, PrivateKey
 
+from thingbox import payload
+
 
 @dataclass
 class Item:
@@ -30,9 +32,19 @@ def get_public_key(server_base_url):
 		raise Exception(f'error {res.status_code}')
 
 
-def encrypt(plaintext, public_key_b58):
+def get_key_rotation_status(server_base_url, auth_token):
+	res = requests.get(
+		url=server_url(server_base_url, '/key-rotation'),
+		headers=dict(Authorization=f'Bearer {auth_token}'))
+	if res.status_code == 200:
+		return res.json()
+	else:
+		raise Exception(f'error: {repr(res)}')
+
+
+def encrypt(plaintext, public_key_b58, compress=False):
 	box = SealedBox(PublicKey(b58decode(public_key_b58)))
-	ciphertext = box.encrypt(plaintext=plaintext.encode())
+	ciphertext = box.encrypt(plaintext=payload.encode(plaintext, compress=compress))
 	return b64encode(ciphertext).decode('utf-8')
 
 
@@ -41,6 +53,21 @@ def generate_private_key():
 	return b58encode(private_key.encode()).decode('utf-8')
 
 
+def create_batch(server_base_url, auth_token, shared_data_plaintext=None, compress=False):
+	shared_data_encrypted_b64 = None
+	if shared_data_plaintext is not None:
+		public_key = get_public_key(server_base_url)
+		shared_data_encrypted_b64 = encrypt(shared_data_plaintext, public_key, compress=compress)
+	res = requests.post(
+		url=server_url(server_base_url, '/batches'),
+		headers=dict(Authorization=f'Bearer {auth_token}'),
+		json=dict(shared_data_encrypted_b64=shared_data_encrypted_b64))
+	if res.status_code == 200:
+		return res.json()['batch']
+	else:
+		raise Exception(f'error: {repr(res)}')
+
+
 def add_item(
 		server_base_url, 
 		auth_token, 
@@ -50,9 +77,10 @@ def add_item(
 		data_plaintext, 
 		template_id, 
 		batch_id=None,
-		close_batch=True):
+		close_batch=True,
+		compress=False):
 	public_key = get_public_key(server_base_url)
-	data_encrypted_b64 = encrypt(data_plaintext, public_key)
+	data_encrypted_b64 = encrypt(data_plaintext, public_key, compress=compress)
 	item = Item(
 			target_type=target_type, 
 			target_id=target_id, 
@@ -84,17 +112,24 @@ def add_items(
 		override_category=None,
 		override_template_id=None,
 		global_data={},
+		compress=False,
 		dry_run=False,
 		log_fn=print):
 	batch_id = None
+	if global_data and len(items) > 0 and not dry_run:
+		batch_id = create_batch(
+			server_base_url=server_base_url,
+			auth_token=auth_token,
+			shared_data_plaintext=json.dumps(global_data),
+			compress=compress)
+		log_fn(f'{batch_id}: CREATED batch with shared data: {repr(global_data)}')
 	for i, item_data in enumerate(items):
 		target_type = override_target_type or item_data[target_type_field] 
 		target_id = override_target_id or item_data[target_id_field]
 		category = override_category or item_data[category_field]
 		template_id = override_template_id or item_data[template_id_field]
-		full_data = { **global_data, **item_data }
 		if dry_run:
-			log_fn(f'#{i} [DRY_RUN]: {target_type} {target_id} ({category}/{template_id}): {repr(full_data)}')
+			log_fn(f'#{i} [DRY_RUN]: {target_type} {target_id} ({category}/{template_id}): {repr({ **global_data, **item_data })}')
 		else:
 			is_last_item = i == len(items) - 1
 			try:
@@ -104,10 +139,11 @@ def add_items(
 					target_type=target_type, 
 					target_id=target_id, 
 					category=category,
-					data_plaintext=json.dumps(full_data),
+					data_plaintext=json.dumps(item_data),
 					template_id=template_id,
 					batch_id=batch_id,
-					close_batch=is_last_item)
+					close_batch=is_last_item,
+					compress=compress)
 				if result and 'batch' in result: batch_id = result['batch']
 				if 'success' in result and not result['success']: raise Exception(repr(result))
 				log_fn(f'{batch_id}#{i}: CREATED {target_type} {target_id} ({category}: {template_id})')
@@ -1,15 +1,24 @@
 from dataclasses import dataclass
 import sqlite3
+import json
 import shutil
+import zlib
 from os import urandom
 from base64 import b64decode
-from typing import Optional
+from binascii import Error as Base64Error
+from typing import Optional, Callable
+from glob import glob
+from urllib.request import pathname2url
 from base58 import b58encode
 from nacl.public import PrivateKey, SealedBox
+from nacl.exceptions import CryptoError
+from hashlib import sha256
 from threading import Lock, Thread
 from datetime import datetime
 from os import path, makedirs
-from time import sleep
+from time import sleep, time
+
+from thingbox import payload
 
 
 @dataclass
@@ -21,6 +30,40 @@ class BackupConfig:
 	backup_on_batch_close: bool = False
 
 
+@dataclass
+class ReplicaConfig:
+	snapshot_path: str
+	name_glob: str
+	poll_interval: int = 60
+	mmap_size: int = 268435456
+	on_reload: Optional[Callable] = None
+
+
+@dataclass
+class ItemShard:
+	filepath: str
+	db: sqlite3.Connection
+	write_mutex: Lock
+
+
+@dataclass
+class KeyRotationConfig:
+	chunk_size: int = 100
+	interval: float = 1.0
+
+
+ITEM_SHARD_ID_RANGE = 2 ** 48
+MAX_ITEM_SHARDS = 32  # keeps ids below 2 ** 53 so they survive JSON numbers in the browser
+
+ITEM_DATA_FORMAT_B64 = 0
+ITEM_DATA_FORMAT_RAW = 1
+
+# replicas don't migrate snapshots, so they must come from a primary running the current schema
+SNAPSHOT_REQUIRED_COLUMNS = {
+	'items': ['data_format', 'key_id'],
+	'batches': ['shared_data', 'shared_data_key_id'],
+}
+
 DEFAULT_SITE_TEMPLATES = {
 	'site-title': '# My thingbox instance',
 	'site-footer': '&copy; 2021 SuperEvilMegaCorp, your soul belongs to us now. (change me)',
@@ -32,25 +75,72 @@ DEFAULT_SITE_TEMPLATES = {
 
 class DB:
 	
-	def __init__(self, filepath, private_key_bytes, id_len_bytes, backup_config=None):
+	def __init__(
+			self, 
+			filepath, 
+			private_key_bytes, 
+			id_len_bytes, 
+			backup_config=None, 
+			conversion_chunk_size=500, 
+			replica_config=None, 
+			item_shards=0, 
+			retired_private_keys_bytes=[], 
+			key_rotation_config=None):
 		self._id_len_bytes = id_len_bytes
 		self._backup_config = backup_config
+		self._replica_config = replica_config
 		self._write_mutex = Lock()
-		self._db = sqlite3.connect(filepath, check_same_thread=False)
-		self._db.row_factory = sqlite3.Row
-		with self._db as sql: sql.execute('PRAGMA foreign_keys = ON')
-		self.ensure_schema()
-		self.ensure_site_templates()
-		print(f'Database opened and initialised: {filepath}')
+		self._item_shards = []
+		if self._replica_config and item_shards: raise Exception('read-only replicas do not support sharded item storage')
+		if self._replica_config:
+			self._snapshot_filepath = self.latest_snapshot()
+			if self._snapshot_filepath is None: raise Exception(f'no snapshots found in: {self._replica_config.snapshot_path}')
+			self._db = self.open_snapshot(self._snapshot_filepath)
+			print(f'Database snapshot opened read-only: {self._snapshot_filepath}')
+			if self.get_setting('item_shards'): raise Exception('snapshot uses sharded item storage, which read-only replicas do not support')
+		else:
+			self._db = sqlite3.connect(filepath, check_same_thread=False)
+			self._db.row_factory = sqlite3.Row
+			with self._db as sql: sql.execute('PRAGMA foreign_keys = ON')
+			self.ensure_schema()
+			self.ensure_site_templates()
+			print(f'Database opened and initialised: {filepath}')
+			self.check_item_shards(filepath, item_shards)
+			if item_shards:
+				self._item_shards = [self.open_item_shard(self.item_shard_filepath(filepath, i), i) for i in range(item_shards)]
+				print(f'Item shards opened and initialised: {", ".join(s.filepath for s in self._item_shards)}')
 		private_key = PrivateKey(private_key_bytes)
-		self._crypto = SealedBox(private_key)
 		self._public_key = private_key.public_key
-		print(f'Cryptographic keys initialised, server public key: {b58encode(self.get_public_key().encode()).decode()}')
+		self._key_id = self.make_key_id(self._public_key)
+		self._encrypt_box = SealedBox(self._public_key)
+		self._boxes = { self._key_id: SealedBox(private_key) }
+		for retired_key_bytes in retired_private_keys_bytes:
+			retired_key = PrivateKey(retired_key_bytes)
+			self._boxes.setdefault(self.make_key_id(retired_key.public_key), SealedBox(retired_key))
+		self._key_rotation = None
+		print(f'Cryptographic keys initialised, server public key: {b58encode(self.get_public_key().encode()).decode()} (key id: {self._key_id}, retired keys: {len(self._boxes) - 1})')
+		if self._replica_config:
+			reload_thread = Thread(target=self.reload_snapshots_periodically, args=())
+			reload_thread.daemon = True
+			reload_thread.start()
+			return
 		if self._backup_config and self._backup_config.backup_interval and self._backup_config.backup_interval > 0:
 			self.backup()
 			backup_thread = Thread(target=self.backup_periodically, args=())
 			backup_thread.daemon = True
 			backup_thread.start()
+		if conversion_chunk_size and conversion_chunk_size > 0:
+			conversion_thread = Thread(target=self.convert_legacy_items, args=(conversion_chunk_size,))
+			conversion_thread.daemon = True
+			conversion_thread.start()
+		if key_rotation_config and key_rotation_config.chunk_size > 0 and len(self._boxes) > 1:
+			rotation_thread = Thread(target=self.rotate_keys, args=(key_rotation_config.chunk_size, key_rotation_config.interval))
+			rotation_thread.daemon = True
+			rotation_thread.start()
+		elif key_rotation_config and key_rotation_config.chunk_size > 0:
+			backfill_thread = Thread(target=self.backfill_key_ids, args=(key_rotation_config.chunk_size, key_rotation_config.interval))
+			backfill_thread.daemon = True
+			backfill_thread.start()
 
 	def ensure_schema(self):
 		with self._write_mutex, self._db as sql:
@@ -71,32 +161,64 @@ class DB:
 					content TEXT NOT NULL
 				)
 			""")
+			sql.execute("""
+				CREATE TABLE IF NOT EXISTS settings (
+					key TEXT NOT NULL PRIMARY KEY,
+					value TEXT NOT NULL
+				)
+			""")
 			sql.execute("""
 				CREATE TABLE IF NOT EXISTS batches (
 					id TEXT NOT NULL PRIMARY KEY, 
 					admin_id INTEGER NOT NULL,
 					created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
 					closed TIMESTAMP,
+					shared_data BLOB,
+					shared_data_key_id TEXT,
 					FOREIGN KEY (admin_id) REFERENCES admins (id)
 				)
 			""")
+			self.ensure_items_schema(sql)
+			batch_columns = [r['name'] for r in sql.execute('PRAGMA table_info(batches)').fetchall()]
+			if 'shared_data' not in batch_columns:
+				sql.execute("""
+					ALTER TABLE batches ADD COLUMN shared_data BLOB
+				""")
+			if 'shared_data_key_id' not in batch_columns:
+				sql.execute("""
+					ALTER TABLE batches ADD COLUMN shared_data_key_id TEXT
+				""")
+
+	def ensure_items_schema(self, sql, foreign_keys=True):
+		# shards live in separate files, so batches and templates can't be referenced from them
+		sql.execute("""
+			CREATE TABLE IF NOT EXISTS items (
+				id INTEGER PRIMARY KEY AUTOINCREMENT, 
+				batch_id TEXT NOT NULL,
+				target_type TEXT NOT NULL, 
+				target_id TEXT NOT NULL, 
+				category TEXT NOT NULL,
+				data BLOB NOT NULL,
+				data_format INTEGER NOT NULL DEFAULT 0,
+				key_id TEXT,
+				template_id TEXT NOT NULL,
+				created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
+				archived BOOLEAN NOT NULL DEFAULT FALSE""" + (""",
+				FOREIGN KEY (batch_id) REFERENCES batches (id),
+				FOREIGN KEY (template_id) REFERENCES templates (id)""" if foreign_keys else '') + """
+			)
+		""")
+		sql.execute("""
+			CREATE INDEX IF NOT EXISTS items_by_target ON items (target_type, target_id, category);
+		""")
+		item_columns = [r['name'] for r in sql.execute('PRAGMA table_info(items)').fetchall()]
+		if 'data_format' not in item_columns:
 			sql.execute("""
-				CREATE TABLE IF NOT EXISTS items (
-					id INTEGER PRIMARY KEY AUTOINCREMENT, 
-					batch_id TEXT NOT NULL,
-					target_type TEXT NOT NULL, 
-					target_id TEXT NOT NULL, 
-					category TEXT NOT NULL,
-					data TEXT NOT NULL,
-					template_id TEXT NOT NULL,
-					created TIMESTAMP NOT NULL DEFAULT CURRENT_TIMESTAMP,
-					archived BOOLEAN NOT NULL DEFAULT FALSE,
-					FOREIGN KEY (batch_id) REFERENCES batches (id),
-					FOREIGN KEY (template_id) REFERENCES templates (id)
-				)
+				ALTER TABLE items ADD COLUMN data_format INTEGER NOT NULL DEFAULT 0
 			""")
+		if 'key_id' not in item_columns:
 			sql.execute("""
-				CREATE INDEX IF NOT EXISTS items_by_target ON items (target_type, target_id, category);
+				ALTER TABLE items ADD COLUMN key_id TEXT
 			""")
 
 	def ensure_site_templates(self):
@@ -106,18 +228,90 @@ class DB:
 					INSERT OR IGNORE INTO templates (id, type, content) VALUES (:template_id, 'site', :content)
 				""", dict(template_id=template_id, content=content))
 
+	def get_setting(self, key):
+		try:
+			with self._db as sql:
+				row = sql.execute('SELECT value FROM settings WHERE key = :key', dict(key=key)).fetchone()
+		except sqlite3.OperationalError:
+			return None
+		return row and row['value']
+
+	def set_setting(self, key, value):
+		with self._write_mutex, self._db as sql:
+			sql.execute("""
+				INSERT OR REPLACE INTO settings (key, value) VALUES (:key, :value)
+			""", dict(key=key, value=str(value)))
+
+	def item_shard_filepath(self, filepath, shard):
+		root, ext = path.splitext(filepath)
+		return f'{root}.items-{shard:02d}{ext or ".db"}'
+
+	def existing_item_shard_filepaths(self, filepath):
+		root, ext = path.splitext(filepath)
+		return sorted(glob(f'{root}.items-[0-9][0-9]{ext or ".db"}'))
+
+	def check_item_shards(self, filepath, item_shards):
+		if item_shards > MAX_ITEM_SHARDS: raise Exception(f'item_shards must be at most {MAX_ITEM_SHARDS}')
+		# items are placed by hash modulo the shard count, so a different count would hide them
+		saved_item_shards = self.get_setting('item_shards')
+		existing_shard_files = self.existing_item_shard_filepaths(filepath)
+		if not item_shards:
+			if saved_item_shards or existing_shard_files:
+				raise Exception(f'{filepath} uses {saved_item_shards or len(existing_shard_files)} item shards, set item_shards to match')
+			return
+		if saved_item_shards is None:
+			if existing_shard_files and len(existing_shard_files) != item_shards:
+				raise Exception(f'found {len(existing_shard_files)} item shard files for {filepath}, set item_shards to match')
+			with self._db as sql:
+				if sql.execute('SELECT COUNT(*) FROM items').fetchone()[0] > 0:
+					raise Exception(f'items table in {filepath} is not empty, cannot enable sharded item storage')
+			self.set_setting('item_shards', item_shards)
+		elif int(saved_item_shards) != item_shards:
+			raise Exception(f'{filepath} uses {saved_item_shards} item shards, cannot change to {item_shards}')
+
+	def open_item_shard(self, filepath, shard_index):
+		shard_db = sqlite3.connect(filepath, check_same_thread=False)
+		shard_db.row_factory = sqlite3.Row
+		shard = ItemShard(filepath=filepath, db=shard_db, write_mutex=Lock())
+		with shard.write_mutex, shard.db as sql:
+			self.ensure_items_schema(sql, foreign_keys=False)
+			# give each shard its own id range so item ids stay unique across shards
+			first_id = shard_index * ITEM_SHARD_ID_RANGE
+			if sql.execute("SELECT COUNT(*) FROM sqlite_sequence WHERE name = 'items'").fetchone()[0] == 0:
+				sql.execute("INSERT INTO sqlite_sequence (name, seq) VALUES ('items', :seq)", dict(seq=first_id))
+			else:
+				sql.execute("UPDATE sqlite_sequence SET seq = :seq WHERE name = 'items' AND seq < :seq", dict(seq=first_id))
+		return shard
+
+	def item_store(self, target_type, target_id):
+		if not self._item_shards: return self._db, self._write_mutex
+		shard = self._item_shards[zlib.crc32(f'{target_type}/{target_id}'.encode()) % len(self._item_shards)]
+		return shard.db, shard.write_mutex
+
+	def item_stores(self):
+		if not self._item_shards: return [(self._db, self._write_mutex)]
+		return [(shard.db, shard.write_mutex) for shard in self._item_shards]
+
 	def backup(self):
 		filename = self._backup_config.name_template.format(**dict(timestamp=datetime.now().strftime('%Y%m%d-%H%M%S.%f')))
-		self._backup_config.backup_path and makedirs(self._backup_config.backup_path, exist_ok=True)
-		self._backup_config.tmp_path and makedirs(self._backup_config.tmp_path, exist_ok=True)
-		create_filepath = path.join(self._backup_config.tmp_path or self._backup_config.backup_path, filename)
-		backup_filepath = path.join(self._backup_config.backup_path, filename)
+		# shards first, so every batch referenced by a shard backup is in the later main backup
+		for i, shard in enumerate(self._item_shards):
+			self.backup_db(shard.db, shard.write_mutex, filename, subdir=f'items-{i:02d}')
+		self.backup_db(self._db, self._write_mutex, filename)
+
+	def backup_db(self, db, write_mutex, filename, subdir=None):
+		backup_path = path.join(self._backup_config.backup_path, subdir) if subdir else self._backup_config.backup_path
+		tmp_path = self._backup_config.tmp_path and (path.join(self._backup_config.tmp_path, subdir) if subdir else self._backup_config.tmp_path)
+		backup_path and makedirs(backup_path, exist_ok=True)
+		tmp_path and makedirs(tmp_path, exist_ok=True)
+		create_filepath = path.join(tmp_path or backup_path, filename)
+		backup_filepath = path.join(backup_path, filename)
 		print(f'Backup started, tmp={create_filepath}, target={backup_filepath}')
-		with self._write_mutex:
+		with write_mutex:
 			backup_db = sqlite3.connect(create_filepath)
-			self._db.backup(backup_db)
+			db.backup(backup_db)
 			backup_db.close()
-		if self._backup_config.tmp_path and create_filepath != backup_filepath:
+		if tmp_path and create_filepath != backup_filepath:
 			shutil.move(src=create_filepath, dst=backup_filepath)
 
 	def backup_periodically(self):
@@ -128,6 +322,46 @@ class DB:
 			except Exception as e:
 				print(f'Error doing backup: {repr(e)}')
 
+	@property
+	def read_only(self):
+		return self._replica_config is not None
+
+	def latest_snapshot(self):
+		snapshots = sorted(glob(path.join(self._replica_config.snapshot_path, self._replica_config.name_glob)))
+		return snapshots[-1] if len(snapshots) > 0 else None
+
+	def open_snapshot(self, filepath):
+		snapshot_db = sqlite3.connect(f'file:{pathname2url(path.abspath(filepath))}?mode=ro&immutable=1', uri=True, check_same_thread=False)
+		snapshot_db.row_factory = sqlite3.Row
+		snapshot_db.execute(f'PRAGMA mmap_size = {int(self._replica_config.mmap_size)}')
+		if (res := snapshot_db.execute('PRAGMA quick_check').fetchone()[0]) != 'ok':
+			snapshot_db.close()
+			raise Exception(f'snapshot failed integrity check: {filepath}: {res}')
+		for table, columns in SNAPSHOT_REQUIRED_COLUMNS.items():
+			table_columns = [r['name'] for r in snapshot_db.execute(f'PRAGMA table_info({table})').fetchall()]
+			if (missing := [c for c in columns if c not in table_columns]):
+				snapshot_db.close()
+				raise Exception(f'snapshot schema is out of date, {table} has no columns: {", ".join(missing)}: {filepath}')
+		return snapshot_db
+
+	def reload_snapshot(self):
+		filepath = self.latest_snapshot()
+		if filepath is None or filepath == self._snapshot_filepath: return False
+		# in-flight queries keep a reference to the old connection, which is closed once they release it
+		self._db = self.open_snapshot(filepath)
+		self._snapshot_filepath = filepath
+		print(f'Database snapshot reloaded: {filepath}')
+		if self._replica_config.on_reload: self._replica_config.on_reload()
+		return True
+
+	def reload_snapshots_periodically(self):
+		while True:
+			sleep(self._replica_config.poll_interval)
+			try:
+				self.reload_snapshot()
+			except Exception as e:
+				print(f'Error reloading snapshot: {repr(e)}')
+
 	def generate_uid(self):
 		return b58encode(urandom(self._id_len_bytes)).decode('utf-8')
 		
@@ -178,14 +412,19 @@ class DB:
 			except sqlite3.IntegrityError:
 				return False
 
-	def create_or_check_batch(self, admin, batch=None):
+	def create_or_check_batch(self, admin, batch=None, shared_data_encrypted=None):
 		if batch is None:
+			shared_data_key_id = None
+			if shared_data_encrypted is not None:
+				plaintext, shared_data_key_id = self.decrypt_bytes(shared_data_encrypted)
+				if self.parse_shared_data(self.decode_plaintext(plaintext)) is None: return None
+				shared_data_encrypted, shared_data_key_id = self.reseal_to_current_key(shared_data_encrypted, plaintext, shared_data_key_id)
 			with self._write_mutex, self._db as sql:
 				try:
 					batch = self.generate_uid()
 					sql.execute("""
-						INSERT INTO batches (id, admin_id) VALUES (:id, :admin_id)
-					""", dict(id=batch, admin_id=admin))
+						INSERT INTO batches (id, admin_id, shared_data, shared_data_key_id) VALUES (:id, :admin_id, :shared_data, :shared_data_key_id)
+					""", dict(id=batch, admin_id=admin, shared_data=shared_data_encrypted, shared_data_key_id=shared_data_key_id))
 					return batch
 				except sqlite3.IntegrityError as e:
 					return None
@@ -216,30 +455,236 @@ class DB:
 			self.backup()
 		return result
 
-	def decrypt_data(self, ciphertext):
+	def has_legacy_items(self):
+		for db, _ in self.item_stores():
+			with db as sql:
+				res = sql.execute("""
+					SELECT 1 FROM items WHERE data_format = :data_format LIMIT 1
+				""", dict(data_format=ITEM_DATA_FORMAT_B64))
+				if res.fetchone() is not None: return True
+		return False
+
+	def convert_legacy_items(self, chunk_size=500):
+		if not self.has_legacy_items(): return 0
+		print('Converting legacy base64 items to raw format')
+		converted = sum(self.convert_legacy_items_in_store(db, write_mutex, chunk_size) for db, write_mutex in self.item_stores())
+		print(f'Converted {converted} legacy items to raw format')
+		return converted
+
+	def convert_legacy_items_in_store(self, db, write_mutex, chunk_size):
+		last_id, converted = 0, 0
+		while True:
+			with write_mutex, db as sql:
+				rows = sql.execute("""
+					SELECT
+						id, data FROM items
+					WHERE
+						id > :last_id
+						AND data_format = :data_format
+					ORDER BY
+						id
+					LIMIT :chunk_size
+				""", dict(last_id=last_id, data_format=ITEM_DATA_FORMAT_B64, chunk_size=chunk_size)).fetchall()
+				if len(rows) == 0: break
+				for r in rows:
+					try:
+						data = b64decode(r['data'], validate=True)
+					except (Base64Error, TypeError, ValueError):
+						print(f'Skipping conversion of item {r["id"]}, data is not valid base64')
+						continue
+					sql.execute("""
+						UPDATE items SET data = :data, data_format = :data_format WHERE id = :id
+					""", dict(id=r['id'], data=data, data_format=ITEM_DATA_FORMAT_RAW))
+					converted += 1
+				last_id = rows[-1]['id']
+			sleep(0)
+		return converted
+
+	def make_key_id(self, public_key):
+		return b58encode(sha256(public_key.encode()).digest()[:8]).decode('utf-8')
+
+	def decrypt_bytes(self, ciphertext, data_format=ITEM_DATA_FORMAT_RAW, key_id=None):
+		if data_format == ITEM_DATA_FORMAT_B64:
+			try:
+				ciphertext = b64decode(ciphertext)
+			except (Base64Error, TypeError, ValueError):
+				return None, None
+		boxes = [(key_id, self._boxes[key_id])] if key_id in self._boxes else self._boxes.items()
+		for box_key_id, box in boxes:
+			try:
+				return box.decrypt(ciphertext=ciphertext), box_key_id
+			except (CryptoError, TypeError, ValueError):
+				continue
+		return None, None
+
+	def reseal_to_current_key(self, ciphertext, plaintext, key_id):
+		# clients may still hold a retired public key, don't store anything the rotation job has already passed
+		if key_id == self._key_id: return ciphertext, key_id
+		return self._encrypt_box.encrypt(plaintext), self._key_id
+
+	def decode_plaintext(self, plaintext):
 		try:
-			return self._crypto.decrypt(ciphertext=b64decode(ciphertext)).decode('utf-8')
+			return payload.decode(plaintext).decode('utf-8')
 		except:
 			return None
 
-	def add_item(self, batch, target_type, target_id, category, data_encrypted_b64, template):
-		if self.decrypt_data(data_encrypted_b64) is None: return False
-		with self._write_mutex, self._db as sql:
+	def decrypt_data(self, ciphertext, data_format=ITEM_DATA_FORMAT_RAW, key_id=None):
+		plaintext, _ = self.decrypt_bytes(ciphertext, data_format=data_format, key_id=key_id)
+		return self.decode_plaintext(plaintext)
+
+	def count_items_to_rotate(self):
+		count = 0
+		for db, _ in self.item_stores():
+			with db as sql:
+				res = sql.execute("""
+					SELECT COUNT(*) FROM items WHERE key_id IS NULL OR key_id != :key_id
+				""", dict(key_id=self._key_id))
+				count += res.fetchone()[0]
+		with self._db as sql:
+			res = sql.execute("""
+				SELECT 
+					COUNT(*) FROM batches 
+				WHERE 
+					shared_data IS NOT NULL 
+					AND (shared_data_key_id IS NULL OR shared_data_key_id != :key_id)
+			""", dict(key_id=self._key_id))
+			count += res.fetchone()[0]
+		return count
+
+	def rotate_keys(self, chunk_size=100, interval=1.0):
+		self._key_rotation = dict(key_id=self._key_id, running=True, total=self.count_items_to_rotate(), done=0, failed=0, started=time(), finished=None)
+		print(f'Re-encrypting to key {self._key_id}, rows to rotate: {self._key_rotation["total"]}')
+		try:
+			for db, write_mutex in self.item_stores():
+				self.reencrypt_rows(db, write_mutex, 'items', 'data', 'data_format', 'key_id', chunk_size, interval)
+			self.reencrypt_rows(self._db, self._write_mutex, 'batches', 'shared_data', None, 'shared_data_key_id', chunk_size, interval)
+		except Exception as e:
+			print(f'Error re-encrypting to key {self._key_id}: {repr(e)}')
+			self._key_rotation['error'] = repr(e)
+		self._key_rotation.update(running=False, finished=time())
+		print(f'Re-encrypted {self._key_rotation["done"]} rows to key {self._key_id}, failed: {self._key_rotation["failed"]}')
+
+	def reencrypt_rows(self, db, write_mutex, table, data_column, format_column, key_id_column, chunk_size, interval):
+		last_rowid = 0
+		while True:
+			with write_mutex, db as sql:
+				rows = sql.execute(f"""
+					SELECT
+						rowid AS row_id, {data_column} AS data, {format_column or ITEM_DATA_FORMAT_RAW} AS data_format, {key_id_column} AS key_id 
+					FROM {table}
+					WHERE
+						rowid > :last_rowid
+						AND {data_column} IS NOT NULL
+						AND ({key_id_column} IS NULL OR {key_id_column} != :key_id)
+					ORDER BY
+						rowid
+					LIMIT :chunk_size
+				""", dict(last_rowid=last_rowid, key_id=self._key_id, chunk_size=chunk_size)).fetchall()
+				if len(rows) == 0: break
+				for r in rows:
+					plaintext, _ = self.decrypt_bytes(r['data'], data_format=r['data_format'], key_id=r['key_id'])
+					if plaintext is None:
+						print(f'Skipping re-encryption of {table} row {r["row_id"]}, no key can decrypt it')
+						self._key_rotation['failed'] += 1
+						continue
+					sql.execute(f"""
+						UPDATE {table} SET {data_column} = :data, {key_id_column} = :key_id{f', {format_column} = :data_format' if format_column else ''} WHERE rowid = :rowid
+					""", dict(rowid=r['row_id'], data=self._encrypt_box.encrypt(plaintext), key_id=self._key_id, data_format=ITEM_DATA_FORMAT_RAW))
+					self._key_rotation['done'] += 1
+				last_rowid = rows[-1]['row_id']
+			sleep(interval)
+
+	def backfill_key_ids(self, chunk_size=100, interval=1.0):
+		# rows stored before key ids were recorded can only be encrypted to the current key when no keys are retired
+		filled = 0
+		for db, write_mutex in self.item_stores():
+			filled += self.backfill_key_id_column(db, write_mutex, 'items', 'data', 'key_id', chunk_size, interval)
+		filled += self.backfill_key_id_column(self._db, self._write_mutex, 'batches', 'shared_data', 'shared_data_key_id', chunk_size, interval)
+		if filled > 0: print(f'Recorded key id {self._key_id} for {filled} rows stored without one')
+		return filled
+
+	def backfill_key_id_column(self, db, write_mutex, table, data_column, key_id_column, chunk_size, interval):
+		with db as sql:
+			max_rowid = sql.execute(f'SELECT MAX(rowid) FROM {table} WHERE {key_id_column} IS NULL').fetchone()[0]
+		filled, last_rowid = 0, 0
+		while max_rowid is not None and last_rowid < max_rowid:
+			with write_mutex, db as sql:
+				res = sql.execute(f"""
+					UPDATE {table} SET {key_id_column} = :key_id 
+					WHERE 
+						rowid > :last_rowid 
+						AND rowid <= :next_rowid 
+						AND {data_column} IS NOT NULL
+						AND {key_id_column} IS NULL
+				""", dict(key_id=self._key_id, last_rowid=last_rowid, next_rowid=last_rowid + chunk_size))
+				filled += res.rowcount
+			last_rowid += chunk_size
+			sleep(interval if res.rowcount > 0 else 0)
+		return filled
+
+	def get_key_rotation_status(self):
+		status = dict(key_id=self._key_id, retired_key_ids=[k for k in self._boxes if k != self._key_id])
+		if len(self._boxes) > 1: status['remaining'] = self.count_items_to_rotate()
+		if self._key_rotation is None: return { **status, **dict(running=False) }
+		status = { **status, **self._key_rotation }
+		# rows that no key could decrypt are skipped, they stay counted in remaining but will never be rotated
+		status['pending'] = max(0, status.get('remaining', 0) - status['failed'])
+		if status['running'] and status['done'] > 0:
+			rate = status['done'] / (time() - status['started'])
+			status['eta_seconds'] = round(status['pending'] / rate)
+		return status
+
+	def item_references_exist(self, batch, template):
+		with self._db as sql:
+			res = sql.execute("""
+				SELECT
+					(SELECT COUNT(*) FROM batches WHERE id = :batch_id)
+					AND (SELECT COUNT(*) FROM templates WHERE id = :template_id)
+			""", dict(batch_id=batch, template_id=template))
+			return bool(res.fetchone()[0])
+
+	def add_item(self, batch, target_type, target_id, category, data_encrypted, template):
+		plaintext, key_id = self.decrypt_bytes(data_encrypted)
+		if self.decode_plaintext(plaintext) is None: return False
+		data_encrypted, key_id = self.reseal_to_current_key(data_encrypted, plaintext, key_id)
+		if self._item_shards and not self.item_references_exist(batch=batch, template=template): return False
+		db, write_mutex = self.item_store(target_type, target_id)
+		with write_mutex, db as sql:
 			try:
 				sql.execute("""
 					INSERT 
-						INTO items (batch_id, target_type, target_id, category, data, template_id) 
-						VALUES (:batch_id, :target_type, :target_id, :category, :data, :template_id)
-				""", dict(batch_id=batch, target_type=target_type, target_id=target_id, category=category, data=data_encrypted_b64, template_id=template))
+						INTO items (batch_id, target_type, target_id, category, data, data_format, key_id, template_id) 
+						VALUES (:batch_id, :target_type, :target_id, :category, :data, :data_format, :key_id, :template_id)
+				""", dict(batch_id=batch, target_type=target_type, target_id=target_id, category=category, data=data_encrypted, data_format=ITEM_DATA_FORMAT_RAW, key_id=key_id, template_id=template))
 				return True
 			except sqlite3.IntegrityError as e:
 				return False
 	
-	def get_items(self, target_type, target_id):
+	def get_batches_shared_data(self, batch_ids):
 		with self._db as sql:
+			res = sql.execute("""
+				SELECT
+					id, shared_data, shared_data_key_id FROM batches
+				WHERE
+					id IN (SELECT value FROM json_each(:batch_ids))
+					AND shared_data IS NOT NULL
+			""", dict(batch_ids=json.dumps(list(batch_ids))))
+			rows = res.fetchall()
+		return { r['id']: self.parse_shared_data(self.decrypt_data(r['shared_data'], key_id=r['shared_data_key_id'])) for r in rows }
+
+	def parse_shared_data(self, shared_data):
+		try:
+			parsed = json.loads(shared_data)
+		except (TypeError, ValueError):
+			return None
+		return parsed if isinstance(parsed, dict) else None
+
+	def get_items(self, target_type, target_id):
+		db, _ = self.item_store(target_type, target_id)
+		with db as sql:
 			res = sql.execute("""
 				SELECT 
-					id, category, data, template_id FROM items 
+					id, category, data, data_format, key_id, template_id, batch_id FROM items 
 				WHERE
 					target_type = :target_type 
 					AND target_id = :target_id
@@ -248,11 +693,17 @@ class DB:
 					created DESC
 			""", dict(target_type=target_type, target_id=target_id))
 		rows = res.fetchall()
-		decrypted_rows = [{ 'data': self.decrypt_data(r['data']), 'template_id': r['template_id'], 'id': r['id'] } for r in rows]
+		shared_data = self.get_batches_shared_data(set(r['batch_id'] for r in rows)) if len(rows) > 0 else {}
+		decrypted_rows = [{ 
+			'data': self.decrypt_data(r['data'], r['data_format'], r['key_id']), 
+			'shared_data': shared_data.get(r['batch_id']), 
+			'template_id': r['template_id'], 
+			'id': r['id'] } for r in rows]
 		return list(filter(lambda x: x['data'] is not None, decrypted_rows))
 
 	def get_items_summary(self, target_type, target_id):
-		with self._db as sql:
+		db, _ = self.item_store(target_type, target_id)
+		with db as sql:
 			res = sql.execute("""
 				SELECT 
 					id, category, template_id, batch_id, created, archived FROM items 
@@ -266,6 +717,29 @@ class DB:
 		rows = res.fetchall()
 		return list(rows)
 
+	def get_items_summary_multi(self, targets):
+		targets_by_store = {}
+		for target_type, target_id in targets:
+			db, _ = self.item_store(target_type, target_id)
+			targets_by_store.setdefault(db, []).append([target_type, target_id])
+		rows = []
+		for db, store_targets in targets_by_store.items():
+			with db as sql:
+				res = sql.execute("""
+					SELECT 
+						items.id, items.target_type, items.target_id, items.category, items.template_id, 
+						items.batch_id, items.created, items.archived 
+					FROM json_each(:targets) AS targets
+						JOIN items ON items.target_type = json_extract(targets.value, '$[0]') 
+							AND items.target_id = json_extract(targets.value, '$[1]')
+					WHERE
+						items.archived = FALSE
+					ORDER BY
+						items.created DESC
+				""", dict(targets=json.dumps(store_targets)))
+			rows += res.fetchall()
+		return sorted(rows, key=lambda r: r['created'], reverse=True) if len(targets_by_store) > 1 else rows
+
 	def get_template(self, template, type='item'):
 		with self._db as sql:
 			res = sql.execute("""
@@ -332,3 +806,6 @@ class DB:
 
 	def get_public_key(self):
 		return self._public_key
+
+	def get_key_id(self):
+		return self._key_id
@@ -0,0 +1,26 @@
+import zlib
+
+
+ZLIB_HEADER = b'\x00tbz1'
+MAX_DECOMPRESSED_BYTES = 1048576
+
+
+class PayloadTooLarge(Exception):
+	pass
+
+
+def encode(plaintext, compress=False):
+	if isinstance(plaintext, str): plaintext = plaintext.encode()
+	if not compress: return plaintext
+	return ZLIB_HEADER + zlib.compress(plaintext, 9)
+
+
+def decode(payload, max_length=MAX_DECOMPRESSED_BYTES):
+	if payload[:len(ZLIB_HEADER)] == ZLIB_HEADER:
+		decompressor = zlib.decompressobj()
+		plaintext = decompressor.decompress(payload[len(ZLIB_HEADER):], max_length)
+		if decompressor.unconsumed_tail or len(plaintext) >= max_length:
+			raise PayloadTooLarge(f'decompressed payload exceeds {max_length} bytes')
+		if not decompressor.eof: raise zlib.error('truncated compressed payload')
+		return plaintext
+	return payload
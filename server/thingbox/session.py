@@ -0,0 +1,26 @@
+import tweepy
+
+
+class UserSession:
+	__slots__ = ('id_str', 'screen_name', 'access_token', 'access_token_secret', 'admin_token', 'admin_id')
+
+	def __init__(self, id_str, screen_name, access_token, access_token_secret, admin_token=None, admin_id=None):
+		self.id_str = id_str
+		self.screen_name = screen_name
+		self.access_token = access_token
+		self.access_token_secret = access_token_secret
+		self.admin_token = admin_token
+		self.admin_id = admin_id
+
+	@classmethod
+	def from_auth(cls, auth, user):
+		return cls(
+			id_str=user.id_str,
+			screen_name=user.screen_name,
+			access_token=auth.access_token,
+			access_token_secret=auth.access_token_secret)
+
+	def make_api(self, consumer_key, consumer_secret):
+		auth = tweepy.OAuthHandler(consumer_key=consumer_key, consumer_secret=consumer_secret)
+		auth.set_access_token(self.access_token, self.access_token_secret)
+		return tweepy.API(auth)